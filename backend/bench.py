@@ -0,0 +1,387 @@
+"""
+Load test / benchmark harness for the marketplace API.
+
+Drives the FastAPI app either in-process (ASGI transport, no network) or over
+HTTP against a running uvicorn, with N concurrent clients per scenario, and
+writes throughput + latency percentiles as JSON so runs can be diffed
+between commits.
+
+Usage (from the backend folder):
+    python bench.py --db bench.db --generate --animals 10000 --output before.json
+    python bench.py --db bench.db --output after.json --compare before.json
+    python bench.py --url http://127.0.0.1:8000 --scenarios browse,detail -c 50
+
+In-process runs also report event-loop lag per scenario, which is how blocking
+calls inside async endpoints (e.g. sync DB access in the chat path) show up.
+
+Per-client rate limits are switched off for in-process runs (all clients share
+one IP); pass --rate-limit to measure with them on. Over HTTP the server's own
+RATE_LIMIT_ENABLED setting applies, so start it with RATE_LIMIT_ENABLED=0 unless
+admission control is what you want to measure.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import uuid
+from collections import Counter
+from datetime import datetime
+
+SCENARIOS = ["browse", "search", "detail", "predict", "chat", "notifications", "favorites", "my_animals", "login"]
+AUTHED_SCENARIOS = ["chat", "notifications", "favorites", "my_animals"]
+LAG_INTERVAL = 0.01
+
+
+# --- STATS ---
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(pct / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def summarize_lag(lags):
+    """Event-loop lag: how late the sampler woke up beyond its LAG_INTERVAL sleep."""
+    ordered = sorted(lags)
+    ms = lambda v: round(v * 1000, 3)
+    return {
+        "samples": len(ordered),
+        "p50_ms": ms(percentile(ordered, 50)),
+        "p99_ms": ms(percentile(ordered, 99)),
+        "max_ms": ms(ordered[-1]) if ordered else 0.0,
+    }
+
+
+def summarize(latencies, errors, status_codes, elapsed):
+    """
+    `latencies` holds successful requests only, so a flood of fast 4xx/5xx replies
+    can't pass for a speed-up; failures are counted in `errors` / `error_rate`.
+    """
+    ordered = sorted(latencies)
+    ms = lambda v: round(v * 1000, 3)
+    total = len(latencies) + errors
+    return {
+        "requests": total,
+        "errors": errors,
+        "error_rate": round(errors / total, 4) if total else 0.0,
+        "status_codes": {str(code): count for code, count in status_codes.items()},
+        "duration_s": round(elapsed, 3),
+        "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "mean_ms": ms(sum(ordered) / len(ordered)) if ordered else 0.0,
+        "p50_ms": ms(percentile(ordered, 50)),
+        "p95_ms": ms(percentile(ordered, 95)),
+        "p99_ms": ms(percentile(ordered, 99)),
+        "max_ms": ms(ordered[-1]) if ordered else 0.0,
+    }
+
+
+# --- SCENARIOS ---
+# Each scenario takes (client, rng, ctx) and returns an httpx response
+async def scenario_browse(client, rng, ctx):
+    return await client.get("/animals/")
+
+async def scenario_search(client, rng, ctx):
+    params = {"search": rng.choice(ctx["breeds"])}
+    if rng.random() < 0.5:
+        params["city"] = rng.choice(ctx["cities"])
+    return await client.get("/animals/", params=params)
+
+async def scenario_detail(client, rng, ctx):
+    return await client.get(f"/animals/{rng.randint(1, ctx['animals'])}")
+
+async def scenario_predict(client, rng, ctx):
+    dist = ctx["dist"]
+    weight, _ = dist.weight_and_price(rng)
+    return await client.post("/predict-price/", data={
+        "weight": weight, "age": dist.age(rng), "breed": dist.breed(rng), "color": dist.color(rng),
+    })
+
+async def scenario_chat(client, rng, ctx):
+    sender_id, token = rng.choice(ctx["tokens"])
+    receiver_id = rng.randint(1, ctx["users"])
+    if receiver_id == sender_id:
+        receiver_id = receiver_id % ctx["users"] + 1
+    return await client.post("/messages/", json={"receiver_id": receiver_id, "content": "Is it available?"},
+                             headers={"Authorization": f"Bearer {token}"})
+
+async def scenario_notifications(client, rng, ctx):
+    _, token = rng.choice(ctx["tokens"])
+    return await client.get("/notifications/unread-count", headers={"Authorization": f"Bearer {token}"})
+
+async def scenario_favorites(client, rng, ctx):
+    _, token = rng.choice(ctx["tokens"])
+    return await client.get("/users/me/favorites", headers={"Authorization": f"Bearer {token}"})
+
+async def scenario_my_animals(client, rng, ctx):
+    _, token = rng.choice(ctx["tokens"])
+    return await client.get("/users/me/animals", headers={"Authorization": f"Bearer {token}"})
+
+async def scenario_login(client, rng, ctx):
+    return await client.post("/login", json={
+        "email": ctx["email_for"](rng.randint(1, ctx["users"])), "password": ctx["password"],
+    })
+
+SCENARIO_FUNCS = {name: globals()[f"scenario_{name}"] for name in SCENARIOS}
+
+
+async def sample_loop_lag(lags, stop):
+    """
+    Sleeps LAG_INTERVAL in a loop and records the overshoot. In-process the app shares
+    this loop, so any blocking call inside an async endpoint shows up here directly.
+    """
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        start = loop.time()
+        await asyncio.sleep(LAG_INTERVAL)
+        lags.append(max(0.0, loop.time() - start - LAG_INTERVAL))
+
+
+async def run_scenario(client, name, ctx, total, concurrency, warmup, seed, measure_lag=False):
+    func = SCENARIO_FUNCS[name]
+    rng = random.Random(seed)
+
+    for _ in range(warmup):
+        await func(client, rng, ctx)
+
+    latencies, status_codes = [], Counter()
+    errors = 0
+    remaining = total
+
+    async def worker():
+        nonlocal remaining, errors
+        while remaining > 0:
+            remaining -= 1
+            start = time.perf_counter()
+            try:
+                response = await func(client, rng, ctx)
+            except Exception:
+                status_codes["exception"] += 1
+                errors += 1
+                continue
+            status_codes[response.status_code] += 1
+            if response.status_code >= 400:
+                errors += 1
+            else:
+                latencies.append(time.perf_counter() - start)
+
+    lags, stop = [], asyncio.Event()
+    sampler = asyncio.create_task(sample_loop_lag(lags, stop)) if measure_lag else None
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    stats = summarize(latencies, errors, status_codes, time.perf_counter() - start)
+
+    if sampler:
+        stop.set()
+        await sampler
+        stats["event_loop_lag"] = summarize_lag(lags)
+    return stats
+
+
+# --- SETUP ---
+def make_client(args):
+    import httpx
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    if args.url:
+        return httpx.AsyncClient(base_url=args.url, timeout=args.timeout, limits=limits)
+
+    from main import app
+    transport = httpx.ASGITransport(app=app)
+    return httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=args.timeout, limits=limits)
+
+
+def dataset_size(args):
+    """Row counts used to pick valid ids. Read from the DB in-process, or trusted from flags over HTTP."""
+    if args.url:
+        return args.users, args.animals
+
+    import database, models
+    from sqlalchemy import func
+    db = database.SessionLocal()
+    try:
+        users = db.query(func.max(models.User.id)).scalar() or 0
+        animals = db.query(func.max(models.Animal.id)).scalar() or 0
+    finally:
+        db.close()
+    return users, animals
+
+
+async def login_tokens(client, ctx, count):
+    tokens = []
+    for i in range(1, min(count, ctx["users"]) + 1):
+        response = await client.post("/login", json={"email": ctx["email_for"](i), "password": ctx["password"]})
+        if response.status_code == 200:
+            tokens.append((i, response.json()["access_token"]))
+    return tokens
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except Exception:
+        return None
+
+
+# --- COMPARISON ---
+def compare(report, baseline, threshold):
+    """
+    Prints per-scenario deltas against a previous report. Returns True if anything
+    regressed past threshold %, or if the error rate went up at all.
+    """
+    regressed = False
+    print(f"\n{'scenario':<10}{'metric':<16}{'baseline':>12}{'current':>12}{'change':>10}")
+    for name, current in report["scenarios"].items():
+        before = baseline.get("scenarios", {}).get(name)
+        if not before:
+            continue
+        old_rate = before.get("error_rate", before["errors"] / before["requests"] if before["requests"] else 0.0)
+        new_rate = current["error_rate"]
+        flag = "  <-- regression" if new_rate > old_rate else ""
+        regressed = regressed or bool(flag)
+        print(f"{name:<10}{'error_rate_%':<16}{old_rate * 100:>12.2f}{new_rate * 100:>12.2f}"
+              f"{(new_rate - old_rate) * 100:>+9.1f}pp{flag}")
+        for metric, higher_is_better in (("throughput_rps", True), ("p50_ms", False),
+                                         ("p95_ms", False), ("p99_ms", False)):
+            old, new = before[metric], current[metric]
+            change = ((new - old) / old * 100) if old else 0.0
+            worse = -change if higher_is_better else change
+            flag = "  <-- regression" if worse > threshold else ""
+            regressed = regressed or bool(flag)
+            print(f"{name:<10}{metric:<16}{old:>12.2f}{new:>12.2f}{change:>+9.1f}%{flag}")
+        if "event_loop_lag" in before and "event_loop_lag" in current:
+            old, new = before["event_loop_lag"]["p99_ms"], current["event_loop_lag"]["p99_ms"]
+            change = ((new - old) / old * 100) if old else 0.0
+            print(f"{name:<10}{'loop_lag_p99_ms':<16}{old:>12.2f}{new:>12.2f}{change:>+9.1f}%")
+    return regressed
+
+
+async def run(args):
+    import bench_data
+
+    if args.generate:
+        import database, models
+        models.Base.metadata.drop_all(bind=database.engine)
+        models.Base.metadata.create_all(bind=database.engine)
+        db = database.SessionLocal()
+        try:
+            print(f"Generating {args.users} users / {args.animals} animals ...", file=sys.stderr)
+            bench_data.generate(db, users=args.users, animals=args.animals, reviews=args.animals // 2,
+                                messages=args.animals * 2, favorites=args.animals // 2, seed=args.seed)
+        finally:
+            db.close()
+
+    users, animals = dataset_size(args)
+    ctx = {
+        "users": users, "animals": animals,
+        "dist": bench_data.Distributions(), "cities": bench_data.CITIES,
+        "email_for": bench_data.email_for, "password": bench_data.BENCH_PASSWORD,
+    }
+    ctx["breeds"] = list(ctx["dist"].breeds)
+
+    scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": datetime.utcnow().isoformat() + "Z",
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "mode": "http" if args.url else "in-process",
+            "target": args.url or (args.db or "default database"),
+            "users": users, "animals": animals,
+            "requests_per_scenario": args.requests,
+            "concurrency": args.concurrency,
+            "seed": args.seed,
+            "rate_limited": None if args.url else args.rate_limit,
+        },
+        "scenarios": {},
+    }
+
+    async with make_client(args) as client:
+        authed = [s for s in scenarios if s in AUTHED_SCENARIOS]
+        if authed:
+            ctx["tokens"] = await login_tokens(client, ctx, args.concurrency)
+            if not ctx["tokens"]:
+                print(f"No synthetic users could log in; skipping {', '.join(authed)}.", file=sys.stderr)
+                scenarios = [s for s in scenarios if s not in authed]
+
+        for name in scenarios:
+            print(f"Running {name} ...", file=sys.stderr)
+            report["scenarios"][name] = await run_scenario(
+                client, name, ctx, args.requests, args.concurrency, args.warmup, args.seed,
+                measure_lag=not args.url)
+
+        # What admission control shed during the run (429s also show up in status_codes)
+        token = os.environ.get("ADMISSION_METRICS_TOKEN", "")
+        response = await client.get("/metrics/admission", headers={"X-Metrics-Token": token})
+        if response.status_code == 200:
+            report["admission"] = response.json()
+
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the marketplace API")
+    parser.add_argument("--db", help="SQLite file to benchmark against in-process (default: the app's DATABASE_URL)")
+    parser.add_argument("--url", help="Benchmark a running server over HTTP instead of in-process")
+    parser.add_argument("--generate", action="store_true", help="Rebuild --db with synthetic data first")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--animals", type=int, default=10000)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        help=f"Comma separated subset of: {', '.join(SCENARIOS)}")
+    parser.add_argument("-n", "--requests", type=int, default=500, help="Requests per scenario")
+    parser.add_argument("-c", "--concurrency", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--rate-limit", action="store_true",
+                        help="Keep per-client rate limits on in-process. Off by default: every bench "
+                             "client shares one IP, so most requests would just measure 429s")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    parser.add_argument("--compare", help="Previous JSON report to diff against")
+    parser.add_argument("--threshold", type=float, default=10.0, help="Regression threshold in percent")
+    args = parser.parse_args()
+
+    unknown = set(s.strip() for s in args.scenarios.split(",")) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+    if args.generate and (args.url or not args.db):
+        parser.error("--generate needs --db and only works in-process")
+    if args.generate and os.path.basename(args.db) == "animal_marketplace.db":
+        parser.error("Refusing to overwrite the main database with synthetic data")
+
+    # Must be set before database.py / rate_limit.py are imported anywhere
+    if args.db:
+        os.environ["DATABASE_URL"] = f"sqlite:///{os.path.abspath(args.db)}"
+    if not args.url and not args.rate_limit:
+        os.environ["RATE_LIMIT_ENABLED"] = "0"
+    if not args.url:
+        # Lets the in-process run read /metrics/admission; over HTTP, export the server's token
+        os.environ.setdefault("ADMISSION_METRICS_TOKEN", uuid.uuid4().hex)
+
+    report = asyncio.run(run(args))
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+        print(f"Report written to {args.output}", file=sys.stderr)
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(report, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
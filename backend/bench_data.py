@@ -0,0 +1,183 @@
+"""
+Synthetic marketplace data for the benchmark suite.
+
+Breed / colour / age / weight / price distributions are sampled from
+model/cleaned_data.csv so generated listings look like the real training data.
+
+Usage (from the backend folder):
+    DATABASE_URL=sqlite:///./bench.db python bench_data.py --animals 100000
+"""
+import argparse
+import csv
+import os
+import random
+import time
+from collections import Counter
+
+from passlib.context import CryptContext
+from sqlalchemy import insert
+
+import database
+import models
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+CSV_PATH = os.path.join(BASE_DIR, "model", "cleaned_data.csv")
+
+# Every synthetic user shares this password so the benchmark can log in as anyone
+BENCH_PASSWORD = "benchpass123"
+BENCH_EMAIL_DOMAIN = "bench.local"
+
+ANIMAL_TYPES = {"Cow": 0.6, "Goat": 0.25, "Buffalo": 0.15}
+CITIES = ["Lahore", "Karachi", "Islamabad", "Peshawar", "Multan", "Faisalabad",
+          "Rawalpindi", "Quetta", "Sialkot", "Hyderabad", "Gujranwala", "Mardan"]
+WORDS = ["healthy", "vaccinated", "calm", "strong", "young", "milking", "pure", "well-fed",
+         "qurbani", "dewormed", "active", "beautiful", "heavy", "farm-raised", "organic"]
+CHAT_LINES = ["Is this animal still available?", "What is your final price?",
+              "Can I visit the farm tomorrow?", "Please share more pictures.",
+              "Yes, it is available.", "Price is negotiable.", "Deal, see you soon."]
+
+BATCH_SIZE = 5000
+
+
+def email_for(user_index):
+    return f"user{user_index}@{BENCH_EMAIL_DOMAIN}"
+
+
+class Distributions:
+    """Empirical distributions from the cattle price dataset."""
+
+    def __init__(self, csv_path=CSV_PATH):
+        self.breeds = Counter()
+        self.colors = Counter()
+        self.ages = Counter()
+        self.weights = []
+        self.price_per_kg = []
+
+        with open(csv_path, newline="") as f:
+            for row in csv.DictReader(f):
+                weight = float(row["weight"].split()[0])
+                self.breeds[row["breed"]] += 1
+                self.colors[row["color"]] += 1
+                self.ages[row["age"]] += 1
+                self.weights.append(weight)
+                self.price_per_kg.append(float(row["price"]) / weight)
+
+    @staticmethod
+    def _pick(rng, counter):
+        return rng.choices(list(counter), weights=list(counter.values()))[0]
+
+    def breed(self, rng):
+        return self._pick(rng, self.breeds)
+
+    def color(self, rng):
+        return self._pick(rng, self.colors)
+
+    def age(self, rng):
+        return self._pick(rng, self.ages)
+
+    def weight_and_price(self, rng):
+        # Resample a real weight with some jitter, then price it with a real PKR/kg ratio
+        weight = max(20.0, rng.choice(self.weights) * rng.uniform(0.9, 1.1))
+        price = weight * rng.choice(self.price_per_kg) * rng.uniform(0.95, 1.05)
+        return round(weight, 1), round(price, -2)
+
+
+def _insert_batches(db, table, rows):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= BATCH_SIZE:
+            db.execute(insert(table), batch)
+            batch = []
+    if batch:
+        db.execute(insert(table), batch)
+    db.commit()
+
+
+def generate(db, users=1000, animals=10000, images_per_animal=2, reviews=5000,
+             messages=20000, favorites=5000, seed=42):
+    """
+    Fills an empty database with synthetic rows. Ids are assigned sequentially
+    from 1, so the benchmark can address users and listings by index.
+    """
+    rng = random.Random(seed)
+    dist = Distributions()
+    # bcrypt is deliberately slow; hash once and share it across all users
+    hashed_pw = CryptContext(schemes=["bcrypt"], deprecated="auto").hash(BENCH_PASSWORD)
+    type_names, type_weights = list(ANIMAL_TYPES), list(ANIMAL_TYPES.values())
+
+    _insert_batches(db, models.User, ({
+        "id": i, "name": f"Bench User {i}", "email": email_for(i), "phone": f"0300{i:07d}",
+        "gender": rng.choice(["Male", "Female"]), "address": rng.choice(CITIES),
+        "hashed_password": hashed_pw, "is_verified": rng.random() < 0.3,
+    } for i in range(1, users + 1)))
+
+    def animal_rows():
+        for i in range(1, animals + 1):
+            weight, price = dist.weight_and_price(rng)
+            breed, color = dist.breed(rng), dist.color(rng)
+            yield {
+                "id": i, "seller_id": rng.randint(1, users), "name": f"{breed} #{i}",
+                "animal_type": rng.choices(type_names, weights=type_weights)[0],
+                "breed": breed, "price": price, "weight": weight, "color": color,
+                "city": rng.choice(CITIES), "views": rng.randint(0, 500), "is_sold": rng.random() < 0.1,
+                "description": f"{dist.age(rng)} old {color} {breed}, " + " ".join(rng.sample(WORDS, 4)),
+            }
+    _insert_batches(db, models.Animal, animal_rows())
+
+    _insert_batches(db, models.AnimalImage, ({
+        "animal_id": a, "image_url": f"http://localhost:8000/static/uploads/bench_{a}_{n}.jpg",
+    } for a in range(1, animals + 1) for n in range(images_per_animal)))
+
+    def review_rows():
+        for _ in range(reviews):
+            reviewer, reviewee = rng.sample(range(1, users + 1), 2)
+            yield {"reviewer_id": reviewer, "reviewee_id": reviewee,
+                   "rating": rng.choices([1, 2, 3, 4, 5], weights=[1, 1, 3, 6, 9])[0],
+                   "comment": rng.choice(CHAT_LINES)}
+    _insert_batches(db, models.Review, review_rows())
+
+    def message_rows():
+        for _ in range(messages):
+            sender, receiver = rng.sample(range(1, users + 1), 2)
+            yield {"sender_id": sender, "receiver_id": receiver,
+                   "content": rng.choice(CHAT_LINES), "is_read": rng.random() < 0.7}
+    _insert_batches(db, models.Message, message_rows())
+
+    # (user_id, animal_id) is the primary key, so pairs must be distinct
+    pairs = set()
+    while len(pairs) < min(favorites, users * animals):
+        pairs.add((rng.randint(1, users), rng.randint(1, animals)))
+    _insert_batches(db, models.favorites, ({"user_id": u, "animal_id": a} for u, a in pairs))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic marketplace database")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--animals", type=int, default=10000)
+    parser.add_argument("--images-per-animal", type=int, default=2)
+    parser.add_argument("--reviews", type=int, default=5000)
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--favorites", type=int, default=5000)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    # Tables are dropped below, so never let this run against the real marketplace
+    if database.DATABASE_URL.endswith("animal_marketplace.db"):
+        raise SystemExit("Refusing to overwrite the main database. Set DATABASE_URL to a scratch database.")
+
+    print(f"Generating into {database.DATABASE_URL} ...")
+    start = time.perf_counter()
+    models.Base.metadata.drop_all(bind=database.engine)
+    models.Base.metadata.create_all(bind=database.engine)
+    db = database.SessionLocal()
+    try:
+        generate(db, users=args.users, animals=args.animals, images_per_animal=args.images_per_animal,
+                 reviews=args.reviews, messages=args.messages, favorites=args.favorites, seed=args.seed)
+    finally:
+        db.close()
+    print(f"Done in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,60 @@
+import os
+
 from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
-DATABASE_URL = "sqlite:///./animal_marketplace.db"
+# Overridable so the benchmark suite can point the app at a synthetic database
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./animal_marketplace.db")
 
-engine = create_engine(DATABASE_URL)
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+connect_args = {"check_same_thread": False} if DATABASE_URL.startswith("sqlite") else {}
+engine = create_engine(DATABASE_URL, connect_args=connect_args)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Async engine for the chat / websocket path, so DB I/O never blocks the event loop.
+# Same database, just the asyncio driver for the dialect. Set ASYNC_DATABASE_URL to
+# use a different driver or URL (e.g. "postgresql+psycopg://..."); otherwise it is
+# derived from DATABASE_URL with the drivers below.
+# Built on first use, so a missing async driver only breaks the chat endpoints.
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+    "mysql": "mysql+aiomysql",
+}
+
+def to_async_url(url: str) -> str:
+    scheme, rest = url.split("://", 1)
+    dialect = scheme.split("+", 1)[0]
+    if dialect not in ASYNC_DRIVERS:
+        raise RuntimeError(f"No async driver configured for '{dialect}'. Set ASYNC_DATABASE_URL.")
+    return f"{ASYNC_DRIVERS[dialect]}://{rest}"
+
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL")
+
+async_engine = None
+AsyncSessionLocal = None
+
+def get_async_sessionmaker():
+    global async_engine, AsyncSessionLocal
+    if AsyncSessionLocal is None:
+        url = ASYNC_DATABASE_URL or to_async_url(DATABASE_URL)
+        # SQLite allows one writer at a time; extra async connections just fight over the
+        # lock (busy waits, "database is locked"), so queue on a single connection instead
+        pool_args = {"pool_size": 1, "max_overflow": 0} if url.startswith("sqlite") and ":memory:" not in url else {}
+        try:
+            async_engine = create_async_engine(url, **pool_args)
+        except ImportError as e:
+            raise RuntimeError(
+                f"Async database driver for '{url.split('://', 1)[0]}' is not installed ({e}). "
+                "Install it or set ASYNC_DATABASE_URL."
+            ) from e
+        AsyncSessionLocal = async_sessionmaker(bind=async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+    return AsyncSessionLocal
+
+async def dispose_async_engine():
+    if async_engine is not None:
+        await async_engine.dispose()
+
 Base = declarative_base()
 
 def get_db():
@@ -14,4 +62,8 @@ def get_db():
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+async def get_async_db():
+    async with get_async_sessionmaker()() as db:
+        yield db
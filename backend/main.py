@@ -1,20 +1,24 @@
 import os
+import hmac
 import shutil
 import uuid
 from typing import List, Optional, Dict
 from datetime import datetime, timedelta
 
-from fastapi import FastAPI, Depends, HTTPException, UploadFile, File, Form, status, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, Depends, HTTPException, UploadFile, File, Form, status, WebSocket, WebSocketDisconnect, Request, Header
 from fastapi.security import OAuth2PasswordBearer
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy.orm import Session
-from sqlalchemy import or_, desc, func
+from sqlalchemy.orm import Session, selectinload
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import or_, desc, func, select, exists
 from passlib.context import CryptContext
 from jose import JWTError, jwt
 
-import models, schemas, database
+import models, schemas, database, rate_limit, migrations
 from ml_utils import predict_animal_price
+from rate_limit import limit_concurrency, ml_limiter, hash_limiter
 
 # --- CONFIGURATION ---
 SECRET_KEY = "supersecretkey"
@@ -29,6 +33,11 @@ app = FastAPI(title="Animal Marketplace API")
 @app.on_event("startup")
 async def startup_event():
     models.Base.metadata.create_all(bind=database.engine)
+    migrations.run_migrations(database.engine)
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await database.dispose_async_engine()
 
 # Middleware
 app.add_middleware(
@@ -76,7 +85,7 @@ def create_access_token(data: dict):
     to_encode.update({"exp": expire})
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(database.get_db)):
+def get_token_email(token: str):
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         email: str = payload.get("sub")
@@ -84,16 +93,49 @@ def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(
             raise HTTPException(status_code=401, detail="Invalid token")
     except JWTError:
         raise HTTPException(status_code=401, detail="Invalid token")
-    
+    return email
+
+def get_seller_ratings(db: Session, seller_ids):
+    """Average rating and review count for many sellers in one grouped query."""
+    if not seller_ids:
+        return {}
+    rows = db.query(models.Review.reviewee_id, func.avg(models.Review.rating), func.count(models.Review.id)) \
+        .filter(models.Review.reviewee_id.in_(seller_ids)).group_by(models.Review.reviewee_id).all()
+    return {uid: (avg or 0.0, count) for uid, avg, count in rows}
+
+def get_request_user(request: Request):
+    """Email from the bearer token if there is a valid one, without touching the DB."""
+    auth = request.headers.get("Authorization", "")
+    if not auth.startswith("Bearer "):
+        return None
+    try:
+        return get_token_email(auth[len("Bearer "):])
+    except HTTPException:
+        return None
+
+def rate_limit_for(route: str):
+    return Depends(rate_limit.rate_limit(route, identify_user=get_request_user))
+
+def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(database.get_db)):
+    email = get_token_email(token)
     user = db.query(models.User).filter(models.User.email == email).first()
     if user is None:
         raise HTTPException(status_code=401, detail="User not found")
     return user
 
+# Same as get_current_user, but on the async session for the chat endpoints
+async def get_current_user_async(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(database.get_async_db)):
+    email = get_token_email(token)
+    result = await db.execute(select(models.User).where(models.User.email == email))
+    user = result.scalars().first()
+    if user is None:
+        raise HTTPException(status_code=401, detail="User not found")
+    return user
+
 
 # --- AUTH ENDPOINTS ---
 
-@app.post("/signup", response_model=schemas.Token)
+@app.post("/signup", response_model=schemas.Token, dependencies=[rate_limit_for("signup"), Depends(limit_concurrency(hash_limiter))])
 def signup(user: schemas.UserCreate, db: Session = Depends(database.get_db)):
     # 1. Check Email
     if db.query(models.User).filter(models.User.email == user.email).first():
@@ -119,7 +161,7 @@ def signup(user: schemas.UserCreate, db: Session = Depends(database.get_db)):
         "user_name": new_user.name, "user_id": new_user.id, "profile_image": new_user.profile_image
     }
 
-@app.post("/login", response_model=schemas.Token)
+@app.post("/login", response_model=schemas.Token, dependencies=[rate_limit_for("login"), Depends(limit_concurrency(hash_limiter))])
 def login(user_data: schemas.UserLogin, db: Session = Depends(database.get_db)):
     user = db.query(models.User).filter(models.User.email == user_data.email).first()
     if not user or not verify_password(user_data.password, user.hashed_password):
@@ -168,7 +210,7 @@ def update_profile_image(
     
     return {"image_url": image_url}
 
-@app.post("/users/change-password")
+@app.post("/users/change-password", dependencies=[rate_limit_for("password"), Depends(limit_concurrency(hash_limiter))])
 def change_password(
     data: schemas.ChangePassword,
     current_user: models.User = Depends(get_current_user),
@@ -192,7 +234,7 @@ def forgot_password(request: schemas.PasswordResetRequest, db: Session = Depends
     db.commit()
     return {"message": "Reset link generated successfully.", "reset_token": reset_token}
 
-@app.post("/reset-password")
+@app.post("/reset-password", dependencies=[rate_limit_for("password"), Depends(limit_concurrency(hash_limiter))])
 def reset_password(data: schemas.PasswordResetConfirm, db: Session = Depends(database.get_db)):
     user = db.query(models.User).filter(models.User.reset_token == data.token).first()
     if not user:
@@ -240,7 +282,7 @@ def create_animal_listing(
         "images": new_animal.images
     }
 
-@app.get("/animals/", response_model=List[schemas.AnimalOut])
+@app.get("/animals/", response_model=List[schemas.AnimalOut], dependencies=[rate_limit_for("browse")])
 def get_animals(
     type: Optional[str] = None, city: Optional[str] = None, min_price: Optional[float] = None,
     max_price: Optional[float] = None, search: Optional[str] = None,
@@ -282,7 +324,9 @@ def get_animal_detail(animal_id: int, db: Session = Depends(database.get_db)):
 
 @app.get("/users/me/animals", response_model=List[schemas.AnimalOut])
 def get_my_animals(current_user: models.User = Depends(get_current_user), db: Session = Depends(database.get_db)):
-    return db.query(models.Animal).filter(models.Animal.seller_id == current_user.id).order_by(models.Animal.created_at.desc()).all()
+    return db.query(models.Animal).filter(models.Animal.seller_id == current_user.id) \
+        .options(selectinload(models.Animal.seller), selectinload(models.Animal.images)) \
+        .order_by(models.Animal.created_at.desc()).all()
 
 @app.delete("/animals/{animal_id}")
 def delete_animal(animal_id: int, current_user: models.User = Depends(get_current_user), db: Session = Depends(database.get_db)):
@@ -298,26 +342,42 @@ def delete_animal(animal_id: int, current_user: models.User = Depends(get_curren
 
 @app.post("/animals/{animal_id}/favorite")
 def toggle_favorite(animal_id: int, current_user: models.User = Depends(get_current_user), db: Session = Depends(database.get_db)):
-    animal = db.query(models.Animal).filter(models.Animal.id == animal_id).first()
-    if not animal: raise HTTPException(status_code=404, detail="Animal not found")
+    if not db.query(exists().where(models.Animal.id == animal_id)).scalar():
+        raise HTTPException(status_code=404, detail="Animal not found")
     
-    if animal in current_user.favorited_animals:
-        current_user.favorited_animals.remove(animal)
-        msg = "Removed from favorites"
-    else:
-        current_user.favorited_animals.append(animal)
-        msg = "Added to favorites"
-    db.commit()
-    return {"message": msg}
+    # Work on the association row directly instead of loading the whole favorites list
+    fav = models.favorites
+    key = (fav.c.user_id == current_user.id) & (fav.c.animal_id == animal_id)
+    if db.query(exists().where(key)).scalar():
+        db.execute(fav.delete().where(key))
+        db.commit()
+        return {"message": "Removed from favorites"}
+
+    try:
+        db.execute(fav.insert().values(user_id=current_user.id, animal_id=animal_id))
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        # Fine if a concurrent request added the same favorite between the check and the insert.
+        # Anything else (e.g. the animal was deleted meanwhile, failing the foreign key) is not.
+        if not db.query(exists().where(key)).scalar():
+            if not db.query(exists().where(models.Animal.id == animal_id)).scalar():
+                raise HTTPException(status_code=404, detail="Animal not found")
+            raise
+    return {"message": "Added to favorites"}
 
 @app.get("/users/me/favorites", response_model=List[schemas.AnimalOut])
 def get_favorites(current_user: models.User = Depends(get_current_user), db: Session = Depends(database.get_db)):
+    animals = db.query(models.Animal) \
+        .join(models.favorites, models.favorites.c.animal_id == models.Animal.id) \
+        .filter(models.favorites.c.user_id == current_user.id) \
+        .options(selectinload(models.Animal.seller), selectinload(models.Animal.images)).all()
+    ratings = get_seller_ratings(db, {a.seller_id for a in animals})
+
     results = []
-    for a in current_user.favorited_animals:
-        seller = a.seller
-        avg = db.query(func.avg(models.Review.rating)).filter(models.Review.reviewee_id == seller.id).scalar() or 0.0
-        count = db.query(models.Review).filter(models.Review.reviewee_id == seller.id).count()
-        seller_dict = {**seller.__dict__, "average_rating": avg, "review_count": count}
+    for a in animals:
+        avg, count = ratings.get(a.seller_id, (0.0, 0))
+        seller_dict = {**a.seller.__dict__, "average_rating": avg, "review_count": count}
         results.append({**a.__dict__, "seller": seller_dict, "images": a.images})
     return results
 
@@ -333,53 +393,54 @@ async def websocket_endpoint(websocket: WebSocket, user_id: int):
     except WebSocketDisconnect:
         manager.disconnect(user_id)
 
+# Chat endpoints use the async session so message I/O never blocks the event loop
+# (and with it every open WebSocket on this worker).
+
 @app.post("/messages/", response_model=schemas.MessageOut)
-async def send_message(msg: schemas.MessageCreate, current_user: models.User = Depends(get_current_user), db: Session = Depends(database.get_db)):
+async def send_message(msg: schemas.MessageCreate, current_user: models.User = Depends(get_current_user_async), db: AsyncSession = Depends(database.get_async_db)):
     new_msg = models.Message(sender_id=current_user.id, receiver_id=msg.receiver_id, content=msg.content)
     db.add(new_msg)
-    db.commit()
-    db.refresh(new_msg)
+    await db.commit()
+    await db.refresh(new_msg)
     await manager.send_personal_message(f"NEW_MESSAGE:{current_user.id}", msg.receiver_id)
     return new_msg
 
 @app.get("/messages/contacts", response_model=List[schemas.ChatContact])
-def get_chat_contacts(current_user: models.User = Depends(get_current_user), db: Session = Depends(database.get_db)):
-    sent_ids = db.query(models.Message.receiver_id).filter(models.Message.sender_id == current_user.id)
-    received_ids = db.query(models.Message.sender_id).filter(models.Message.receiver_id == current_user.id)
-    contact_ids = set([r[0] for r in sent_ids] + [r[0] for r in received_ids])
+async def get_chat_contacts(current_user: models.User = Depends(get_current_user_async), db: AsyncSession = Depends(database.get_async_db)):
+    sent_ids = await db.execute(select(models.Message.receiver_id).where(models.Message.sender_id == current_user.id))
+    received_ids = await db.execute(select(models.Message.sender_id).where(models.Message.receiver_id == current_user.id))
+    contact_ids = set(sent_ids.scalars()) | set(received_ids.scalars())
     
     contacts = []
     for uid in contact_ids:
-        user = db.query(models.User).filter(models.User.id == uid).first()
+        user = await db.get(models.User, uid)
         if user:
-            last_msg = db.query(models.Message).filter(
+            result = await db.execute(select(models.Message).where(
                 or_((models.Message.sender_id == current_user.id) & (models.Message.receiver_id == uid),
                     (models.Message.sender_id == uid) & (models.Message.receiver_id == current_user.id))
-            ).order_by(models.Message.timestamp.desc()).first()
+            ).order_by(models.Message.timestamp.desc()).limit(1))
+            last_msg = result.scalars().first()
             contacts.append({"user_id": user.id, "name": user.name, "image": user.profile_image, "last_message": last_msg.content if last_msg else ""})
     return contacts
 
 @app.get("/messages/{other_user_id}", response_model=List[schemas.MessageOut])
-def get_chat_history(other_user_id: int, current_user: models.User = Depends(get_current_user), db: Session = Depends(database.get_db)):
-    messages = db.query(models.Message).filter(
+async def get_chat_history(other_user_id: int, current_user: models.User = Depends(get_current_user_async), db: AsyncSession = Depends(database.get_async_db)):
+    result = await db.execute(select(models.Message).where(
         or_((models.Message.sender_id == current_user.id) & (models.Message.receiver_id == other_user_id),
             (models.Message.sender_id == other_user_id) & (models.Message.receiver_id == current_user.id))
-    ).order_by(models.Message.timestamp.asc()).all()
-
-    # Mark as read
-    unread_messages = db.query(models.Message).filter(
-        models.Message.sender_id == other_user_id,
-        models.Message.receiver_id == current_user.id,
-        models.Message.is_read == False
-    ).all()
+    ).order_by(models.Message.timestamp.asc()))
+    messages = result.scalars().all()
+
+    # Mark as read (the unread ones are already in the history we just loaded)
+    unread_messages = [m for m in messages if m.sender_id == other_user_id and not m.is_read]
     if unread_messages:
         for m in unread_messages: m.is_read = True
-        db.commit()
+        await db.commit()
     return messages
 
 @app.get("/notifications/unread-count")
-def get_unread_count(current_user: models.User = Depends(get_current_user), db: Session = Depends(database.get_db)):
-    count = db.query(models.Message).filter(models.Message.receiver_id == current_user.id, models.Message.is_read == False).count()
+async def get_unread_count(current_user: models.User = Depends(get_current_user_async), db: AsyncSession = Depends(database.get_async_db)):
+    count = await db.scalar(select(func.count(models.Message.id)).where(models.Message.receiver_id == current_user.id, models.Message.is_read == False))
     return {"count": count}
 
 @app.post("/reviews/", response_model=schemas.ReviewOut)
@@ -399,11 +460,20 @@ def get_user_reviews(user_id: int, db: Session = Depends(database.get_db)):
         results.append({"id": r.id, "reviewer_name": reviewer.name if reviewer else "Unknown", "rating": r.rating, "comment": r.comment, "created_at": r.created_at})
     return results
 
-@app.post("/predict-price/")
+@app.post("/predict-price/", dependencies=[rate_limit_for("predict"), Depends(limit_concurrency(ml_limiter))])
 def get_price_prediction(weight: float = Form(...), age: str = Form(...), breed: str = Form(...), color: str = Form(...)):
     estimated_price = predict_animal_price(weight, age, breed, color)
     return {"estimated_price": estimated_price}
 
+@app.get("/metrics/admission")
+def get_admission_metrics(x_metrics_token: Optional[str] = Header(None)):
+    # Off unless ADMISSION_METRICS_TOKEN is configured; limiter internals aren't public
+    if not rate_limit.METRICS_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not x_metrics_token or not hmac.compare_digest(x_metrics_token, rate_limit.METRICS_TOKEN):
+        raise HTTPException(status_code=401, detail="Invalid metrics token")
+    return rate_limit.metrics.snapshot()
+
 
 
 @app.get("/users/me", response_model=schemas.UserProfile)
@@ -0,0 +1,91 @@
+"""
+In-place schema upgrades for existing databases.
+
+create_all() only creates missing tables, so changes to tables that already exist
+have to be applied here. Every step is idempotent and runs on startup; it can
+also be run by hand:
+    python migrations.py
+"""
+from sqlalchemy import MetaData, inspect, text
+
+import models
+
+# Tables a rebuild of `favorites` may leave behind if it was interrupted on a backend
+# without transactional DDL (or by the first version of this migration)
+FAVORITES_LEFTOVERS = ("favorites_new", "favorites_old")
+
+
+def _copy_favorites(conn, source, target):
+    """Copies distinct, non-NULL pairs from source into target, skipping ones already there."""
+    conn.execute(text(
+        f"INSERT INTO {target} (user_id, animal_id) "
+        f"SELECT DISTINCT s.user_id, s.animal_id FROM {source} s "
+        f"WHERE s.user_id IS NOT NULL AND s.animal_id IS NOT NULL "
+        f"AND NOT EXISTS (SELECT 1 FROM {target} t WHERE t.user_id = s.user_id AND t.animal_id = s.animal_id)"
+    ))
+
+
+def _favorites_table(name):
+    # A copy of `favorites` under another name. users/animals come along only so the
+    # foreign keys resolve; the index is created once the table has its final name.
+    meta = MetaData()
+    models.User.__table__.to_metadata(meta)
+    models.Animal.__table__.to_metadata(meta)
+    table = models.favorites.to_metadata(meta, name=name)
+    table.indexes.clear()
+    return table
+
+
+def migrate_favorites(conn):
+    """
+    Give `favorites` its (user_id, animal_id) primary key and reverse index.
+
+    Older databases have the table without any key, and possibly with duplicate
+    or NULL rows. The old table is only dropped once its rows are safely copied:
+    build favorites_new, copy the distinct pairs, drop favorites, rename.
+    """
+    tables = set(inspect(conn).get_table_names())
+
+    if "favorites" in tables:
+        pk = inspect(conn).get_pk_constraint("favorites").get("constrained_columns") or []
+        if sorted(pk) != ["animal_id", "user_id"]:
+            print("Migrating favorites: adding primary key...")
+            if "favorites_new" not in tables:
+                _favorites_table("favorites_new").create(conn)
+            _copy_favorites(conn, "favorites", "favorites_new")
+            conn.execute(text("DROP TABLE favorites"))
+            conn.execute(text("ALTER TABLE favorites_new RENAME TO favorites"))
+    elif "favorites_new" in tables:
+        # Interrupted between the drop and the rename
+        conn.execute(text("ALTER TABLE favorites_new RENAME TO favorites"))
+    else:
+        return
+
+    # Rows stranded by an interrupted rebuild are merged back, never dropped unread
+    tables = set(inspect(conn).get_table_names())
+    for leftover in FAVORITES_LEFTOVERS:
+        if leftover in tables:
+            print(f"Migrating favorites: recovering rows from {leftover}...")
+            _copy_favorites(conn, leftover, "favorites")
+            conn.execute(text(f"DROP TABLE {leftover}"))
+
+    # CREATE INDEX IF NOT EXISTS, portably (MySQL has no IF NOT EXISTS for indexes)
+    for index in models.favorites.indexes:
+        index.create(conn, checkfirst=True)
+
+
+def run_migrations(engine):
+    with engine.connect() as conn:
+        if conn.dialect.name == "sqlite":
+            # pysqlite doesn't open a transaction for DDL, so each statement would commit
+            # on its own. BEGIN IMMEDIATE makes the rebuild atomic and takes the write
+            # lock up front, so workers starting together run this one at a time.
+            conn.exec_driver_sql("BEGIN IMMEDIATE")
+        migrate_favorites(conn)
+        conn.commit()
+
+
+if __name__ == "__main__":
+    from database import engine
+    run_migrations(engine)
+    print("Migrations applied.")
@@ -1,14 +1,17 @@
-from sqlalchemy import Column, Integer, String, Float, Boolean, ForeignKey, DateTime, Text, Table
+from sqlalchemy import Column, Integer, String, Float, Boolean, ForeignKey, DateTime, Text, Table, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from database import Base
 
 # Association Table for Favorites
 # extend_existing=True prevents "Table already defined" errors during auto-reload
+# (user_id, animal_id) is the primary key, so a user can favorite an animal only once and
+# "my favorites" is an index range scan; the reverse index serves lookups by animal.
 favorites = Table(
     'favorites', Base.metadata,
-    Column('user_id', Integer, ForeignKey('users.id')),
-    Column('animal_id', Integer, ForeignKey('animals.id')),
+    Column('user_id', Integer, ForeignKey('users.id'), primary_key=True),
+    Column('animal_id', Integer, ForeignKey('animals.id'), primary_key=True),
+    Index('ix_favorites_animal_user', 'animal_id', 'user_id'),
     extend_existing=True 
 )
 
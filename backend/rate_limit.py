@@ -0,0 +1,270 @@
+"""
+Admission control for the expensive endpoints.
+
+- Token buckets per client IP and per logged-in user. Each route spends its own
+  cost from ROUTE_COSTS, so one bcrypt login weighs more than one listing page.
+- Bounded concurrency with a queue timeout for the ML and password-hashing paths,
+  so they can't take over the whole threadpool. Waiting happens on the event loop,
+  not in a worker thread.
+- Rejected requests get 429 with Retry-After, and every shed request is counted.
+
+Buckets live in process memory by default. Set RATE_LIMIT_REDIS_URL to share them
+between uvicorn workers (needs the `redis` package).
+
+The concurrency limits are per worker and default to the CPU count, since both paths
+are CPU-bound. Tune them with ADMISSION_PREDICT_CONCURRENCY / ADMISSION_HASH_CONCURRENCY
+and the queue timeouts (seconds) with ADMISSION_PREDICT_QUEUE_TIMEOUT /
+ADMISSION_HASH_QUEUE_TIMEOUT.
+
+Behind a reverse proxy, set RATE_LIMIT_TRUSTED_PROXY_HOPS so IP buckets key on the
+real client from X-Forwarded-For. Clients behind one carrier NAT still share an IP
+bucket; logged-in users also get their own bucket.
+"""
+import asyncio
+import math
+import os
+import time
+from collections import Counter
+from typing import Callable, Optional
+
+from fastapi import HTTPException, Request
+
+# --- CONFIGURATION ---
+# Buckets refill at RATE tokens per second, up to BURST tokens
+IP_RATE = 10.0
+IP_BURST = 60
+USER_RATE = 10.0
+USER_BURST = 60
+
+# Tokens spent per request, per route
+ROUTE_COSTS = {
+    "browse": 2,
+    "predict": 5,
+    "login": 10,
+    "signup": 10,
+    "password": 10,
+}
+
+REDIS_URL = os.getenv("RATE_LIMIT_REDIS_URL")
+# Number of reverse proxies in front of the app that append to X-Forwarded-For.
+# 0 (default) ignores the header, since clients can send anything in it. Without it,
+# everyone behind a proxy or carrier NAT shares the proxy's IP bucket.
+TRUSTED_PROXY_HOPS = int(os.getenv("RATE_LIMIT_TRUSTED_PROXY_HOPS", "0"))
+# /metrics/admission is disabled unless this is set; callers send it as X-Metrics-Token
+METRICS_TOKEN = os.getenv("ADMISSION_METRICS_TOKEN")
+# Slots per worker for the CPU-bound paths. More slots than cores only makes each
+# request slower, so queue the excess instead.
+PREDICT_CONCURRENCY = int(os.getenv("ADMISSION_PREDICT_CONCURRENCY", str(os.cpu_count() or 1)))
+PREDICT_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_PREDICT_QUEUE_TIMEOUT", "2.0"))
+HASH_CONCURRENCY = int(os.getenv("ADMISSION_HASH_CONCURRENCY", str(os.cpu_count() or 1)))
+# A bcrypt hash takes ~0.25s, so queued logins can wait longer than predictions
+HASH_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_HASH_QUEUE_TIMEOUT", "5.0"))
+# Turns the per-client buckets off (e.g. load tests from one IP); concurrency limits stay on
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "1") != "0"
+
+
+# --- BUCKET BACKENDS ---
+# Backends take every bucket a request is charged to and spend from them all or from
+# none, so a request rejected by one bucket (e.g. per user) costs nothing in the others.
+class InMemoryBackend:
+    """Token buckets in a dict. Per process, so each uvicorn worker enforces its own limits."""
+
+    def __init__(self, max_keys: int = 100_000):
+        self.max_keys = max_keys
+        self._buckets = {}
+
+    async def consume(self, buckets, cost: float) -> float:
+        """
+        Spends `cost` tokens from every (key, rate, burst) bucket. Returns 0 if admitted,
+        else seconds until all of them would have enough (nothing is spent then).
+        """
+        now = time.monotonic()
+        levels = []
+        wait = 0.0
+        for key, rate, burst in buckets:
+            tokens, last = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - last) * rate)
+            levels.append((key, tokens))
+            if tokens < cost:
+                wait = max(wait, (cost - tokens) / rate)
+
+        for key, tokens in levels:
+            self._buckets[key] = (tokens if wait else tokens - cost, now)
+
+        if len(self._buckets) > self.max_keys:
+            self._prune(now)
+        return wait
+
+    def _prune(self, now):
+        # Drop buckets that have refilled completely; they are the same as a new one
+        refill_time = max(IP_BURST / IP_RATE, USER_BURST / USER_RATE)
+        full = [k for k, (tokens, last) in self._buckets.items() if now - last > refill_time]
+        for k in full:
+            del self._buckets[k]
+
+
+class RedisBackend:
+    """Token buckets in Redis, shared by all workers. The refill/spend is one atomic Lua script."""
+
+    # KEYS: bucket keys. ARGV: cost, now, then rate/burst pairs in the same order as KEYS.
+    SCRIPT = """
+    local cost = tonumber(ARGV[1])
+    local now = tonumber(ARGV[2])
+    local levels = {}
+    local wait = 0
+    for i, key in ipairs(KEYS) do
+        local rate = tonumber(ARGV[1 + 2 * i])
+        local burst = tonumber(ARGV[2 + 2 * i])
+        local data = redis.call('HMGET', key, 'tokens', 'ts')
+        local tokens = tonumber(data[1]) or burst
+        local ts = tonumber(data[2]) or now
+        tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+        levels[i] = tokens
+        if tokens < cost then
+            wait = math.max(wait, (cost - tokens) / rate)
+        end
+    end
+    for i, key in ipairs(KEYS) do
+        local rate = tonumber(ARGV[1 + 2 * i])
+        local burst = tonumber(ARGV[2 + 2 * i])
+        local tokens = levels[i]
+        if wait == 0 then
+            tokens = tokens - cost
+        end
+        redis.call('HSET', key, 'tokens', tokens, 'ts', now)
+        redis.call('EXPIRE', key, math.ceil(burst / rate) + 1)
+    end
+    return tostring(wait)
+    """
+
+    def __init__(self, url: str):
+        try:
+            import redis.asyncio as redis
+        except ImportError:
+            raise RuntimeError("RATE_LIMIT_REDIS_URL is set but the 'redis' package is not installed")
+        self._client = redis.from_url(url)
+        self._script = self._client.register_script(self.SCRIPT)
+
+    async def consume(self, buckets, cost: float) -> float:
+        # Wall clock, since the timestamp is compared across processes
+        args = [cost, time.time()]
+        for _, rate, burst in buckets:
+            args += [rate, burst]
+        return float(await self._script(keys=[key for key, _, _ in buckets], args=args))
+
+
+# --- CONCURRENCY LIMITER ---
+class ConcurrencyLimiter:
+    """At most `limit` requests inside at once; others queue for up to `queue_timeout` seconds."""
+
+    def __init__(self, name: str, limit: int, queue_timeout: float):
+        self.name = name
+        self.limit = limit
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.waiting = 0
+        self._semaphore = asyncio.Semaphore(limit)
+
+    async def acquire(self) -> bool:
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self.waiting -= 1
+        self.in_flight += 1
+        return True
+
+    def release(self):
+        self.in_flight -= 1
+        self._semaphore.release()
+
+
+# --- METRICS ---
+class AdmissionMetrics:
+    def __init__(self):
+        self.admitted = Counter()
+        self.shed = Counter()
+
+    def snapshot(self):
+        shed_by_route = {}
+        for (route, reason), count in self.shed.items():
+            shed_by_route.setdefault(route, {})[reason] = count
+        return {
+            "admitted": dict(self.admitted),
+            "shed": shed_by_route,
+            "limiters": {
+                l.name: {"limit": l.limit, "in_flight": l.in_flight, "waiting": l.waiting}
+                for l in (ml_limiter, hash_limiter)
+            },
+        }
+
+
+backend = RedisBackend(REDIS_URL) if REDIS_URL else InMemoryBackend()
+metrics = AdmissionMetrics()
+
+# Sized per worker: these bound how many threadpool slots the slow paths may hold
+ml_limiter = ConcurrencyLimiter("predict", limit=PREDICT_CONCURRENCY, queue_timeout=PREDICT_QUEUE_TIMEOUT)
+hash_limiter = ConcurrencyLimiter("password_hash", limit=HASH_CONCURRENCY, queue_timeout=HASH_QUEUE_TIMEOUT)
+
+
+def too_many_requests(retry_after: float):
+    return HTTPException(
+        status_code=429,
+        detail="Too many requests, please try again later",
+        headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+    )
+
+
+def client_ip(request: Request) -> str:
+    """
+    The peer address, or with TRUSTED_PROXY_HOPS set, the address our outermost proxy
+    saw: each proxy appends the peer it got the request from, so the client is the
+    entry TRUSTED_PROXY_HOPS from the right. Anything further left is client-supplied.
+    """
+    if TRUSTED_PROXY_HOPS > 0:
+        forwarded = [ip.strip() for ip in request.headers.get("X-Forwarded-For", "").split(",") if ip.strip()]
+        if len(forwarded) >= TRUSTED_PROXY_HOPS:
+            return forwarded[-TRUSTED_PROXY_HOPS]
+    return request.client.host if request.client else "unknown"
+
+
+# --- DEPENDENCIES ---
+def rate_limit(route: str, identify_user: Optional[Callable[[Request], Optional[str]]] = None):
+    """
+    Dependency that charges ROUTE_COSTS[route] to the caller's IP bucket and,
+    when identify_user returns someone, to that user's bucket as well.
+    """
+    cost = ROUTE_COSTS.get(route, 1)
+
+    async def dependency(request: Request):
+        if not RATE_LIMIT_ENABLED:
+            return
+        buckets = [(f"rl:ip:{client_ip(request)}", IP_RATE, IP_BURST)]
+        user = identify_user(request) if identify_user else None
+        if user:
+            buckets.append((f"rl:user:{user}", USER_RATE, USER_BURST))
+
+        wait = await backend.consume(buckets, min(cost, IP_BURST, USER_BURST))
+        if wait > 0:
+            metrics.shed[(route, "rate_limit")] += 1
+            raise too_many_requests(wait)
+        metrics.admitted[route] += 1
+
+    return dependency
+
+
+def limit_concurrency(limiter: ConcurrencyLimiter):
+    """Dependency that holds a limiter slot for the duration of the request."""
+
+    async def dependency():
+        if not await limiter.acquire():
+            metrics.shed[(limiter.name, "queue_timeout")] += 1
+            raise too_many_requests(limiter.queue_timeout)
+        try:
+            yield
+        finally:
+            limiter.release()
+
+    return dependency
@@ -0,0 +1,101 @@
+"""
+Tests for migrations: rebuilding a legacy `favorites` table in place.
+
+Run from the backend folder:
+    python -m pytest tests
+"""
+import pytest
+from sqlalchemy import create_engine, inspect, text
+
+import migrations
+import models
+
+LEGACY_ROWS = [(1, 1), (1, 1), (1, 2), (2, 1), (None, 2), (2, None)]
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'legacy.db'}")
+    # Everything except favorites from the current models, then favorites as it used to be
+    tables = [t for t in models.Base.metadata.sorted_tables if t.name != "favorites"]
+    models.Base.metadata.create_all(bind=engine, tables=tables)
+    with engine.begin() as conn:
+        conn.execute(text("INSERT INTO users (id, name, email, phone, hashed_password) VALUES "
+                          "(1, 'A', 'a@x', '1', 'h'), (2, 'B', 'b@x', '2', 'h')"))
+        conn.execute(text("INSERT INTO animals (id, seller_id) VALUES (1, 1), (2, 2)"))
+        conn.execute(text("CREATE TABLE favorites (user_id INTEGER REFERENCES users (id), "
+                          "animal_id INTEGER REFERENCES animals (id))"))
+        for user_id, animal_id in LEGACY_ROWS:
+            conn.execute(text("INSERT INTO favorites VALUES (:u, :a)"), {"u": user_id, "a": animal_id})
+    yield engine
+    engine.dispose()
+
+
+def favorite_rows(engine, table="favorites"):
+    with engine.connect() as conn:
+        rows = conn.execute(text(f"SELECT user_id, animal_id FROM {table}"))
+        # NULLs sort first so legacy rows compare too
+        return sorted((tuple(r) for r in rows), key=lambda r: tuple(-1 if v is None else v for v in r))
+
+
+def assert_migrated(engine):
+    inspector = inspect(engine)
+    assert sorted(inspector.get_pk_constraint("favorites")["constrained_columns"]) == ["animal_id", "user_id"]
+    indexes = {i["name"]: i["column_names"] for i in inspector.get_indexes("favorites")}
+    assert indexes["ix_favorites_animal_user"] == ["animal_id", "user_id"]
+    assert not set(migrations.FAVORITES_LEFTOVERS) & set(inspector.get_table_names())
+
+
+def test_legacy_favorites_get_key_and_index_without_duplicates_or_nulls(engine):
+    migrations.run_migrations(engine)
+
+    assert favorite_rows(engine) == [(1, 1), (1, 2), (2, 1)]
+    assert_migrated(engine)
+
+    # Running again is a no-op
+    migrations.run_migrations(engine)
+    assert favorite_rows(engine) == [(1, 1), (1, 2), (2, 1)]
+
+
+def test_failed_copy_rolls_back_and_keeps_the_legacy_rows(engine, monkeypatch):
+    def broken_copy(conn, source, target):
+        raise RuntimeError("copy failed")
+    monkeypatch.setattr(migrations, "_copy_favorites", broken_copy)
+
+    with pytest.raises(RuntimeError):
+        migrations.run_migrations(engine)
+
+    assert favorite_rows(engine) == [(None, 2), (1, 1), (1, 1), (1, 2), (2, None), (2, 1)]
+    assert "favorites_new" not in inspect(engine).get_table_names()
+    assert inspect(engine).get_pk_constraint("favorites")["constrained_columns"] == []
+
+    monkeypatch.undo()
+    migrations.run_migrations(engine)
+    assert favorite_rows(engine) == [(1, 1), (1, 2), (2, 1)]
+
+
+def test_rows_stranded_in_a_leftover_table_are_recovered(engine):
+    # What an interrupted rebuild used to leave: an empty keyed table, data in favorites_old
+    with engine.begin() as conn:
+        conn.execute(text("ALTER TABLE favorites RENAME TO favorites_old"))
+    models.favorites.create(engine)
+    with engine.begin() as conn:
+        conn.execute(text("INSERT INTO favorites VALUES (2, 2)"))
+
+    migrations.run_migrations(engine)
+
+    assert favorite_rows(engine) == [(1, 1), (1, 2), (2, 1), (2, 2)]
+    assert_migrated(engine)
+
+
+def test_interrupted_before_rename_is_finished(engine):
+    # Dropped the old table but never renamed the new one
+    migrations._favorites_table("favorites_new").create(engine)
+    with engine.begin() as conn:
+        migrations._copy_favorites(conn, "favorites", "favorites_new")
+        conn.execute(text("DROP TABLE favorites"))
+
+    migrations.run_migrations(engine)
+
+    assert favorite_rows(engine) == [(1, 1), (1, 2), (2, 1)]
+    assert_migrated(engine)
@@ -0,0 +1,154 @@
+"""
+Tests for rate_limit: token bucket math, Retry-After, the concurrency limiter and client IPs.
+
+Run from the backend folder:
+    python -m pytest tests
+"""
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+from starlette.requests import Request
+
+import rate_limit
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(rate_limit.time, "monotonic", fake)
+    return fake
+
+
+def make_request(xff=None, host="10.0.0.1"):
+    headers = []
+    if xff:
+        headers.append((b"x-forwarded-for", xff.encode()))
+    return Request({"type": "http", "headers": headers, "client": (host, 1234)})
+
+
+def consume(backend, buckets, cost):
+    return asyncio.run(backend.consume(buckets, cost))
+
+
+# --- TOKEN BUCKETS ---
+def test_new_bucket_starts_full(clock):
+    backend = rate_limit.InMemoryBackend()
+    for _ in range(6):
+        assert consume(backend, [("k", 10.0, 60)], 10) == 0
+    assert consume(backend, [("k", 10.0, 60)], 10) > 0
+
+
+def test_retry_after_is_time_to_refill_the_shortfall(clock):
+    backend = rate_limit.InMemoryBackend()
+    assert consume(backend, [("k", 2.0, 10)], 10) == 0
+    # Empty bucket, 4 tokens needed at 2 tokens/s
+    assert consume(backend, [("k", 2.0, 10)], 4) == pytest.approx(2.0)
+    clock.now += 1.5
+    assert consume(backend, [("k", 2.0, 10)], 4) == pytest.approx(0.5)
+
+
+def test_tokens_refill_over_time_up_to_burst(clock):
+    backend = rate_limit.InMemoryBackend()
+    assert consume(backend, [("k", 10.0, 60)], 60) == 0
+    clock.now += 2
+    assert consume(backend, [("k", 10.0, 60)], 20) == 0
+    assert consume(backend, [("k", 10.0, 60)], 1) > 0
+
+    # A long idle period never banks more than `burst`
+    clock.now += 3600
+    assert consume(backend, [("k", 10.0, 60)], 60) == 0
+    assert consume(backend, [("k", 10.0, 60)], 1) > 0
+
+
+def test_rejected_request_spends_from_no_bucket(clock):
+    backend = rate_limit.InMemoryBackend()
+    assert consume(backend, [("user", 10.0, 60)], 55) == 0
+
+    # The user bucket can't cover it, so the IP bucket must stay full
+    assert consume(backend, [("ip", 10.0, 60), ("user", 10.0, 60)], 10) == pytest.approx(0.5)
+    assert consume(backend, [("ip", 10.0, 60)], 60) == 0
+
+
+def test_too_many_requests_rounds_retry_after_up():
+    assert rate_limit.too_many_requests(0.2).headers["Retry-After"] == "1"
+    assert rate_limit.too_many_requests(2.1).headers["Retry-After"] == "3"
+    assert rate_limit.too_many_requests(0.2).status_code == 429
+
+
+def test_rate_limit_dependency_returns_429(clock, monkeypatch):
+    monkeypatch.setattr(rate_limit, "backend", rate_limit.InMemoryBackend())
+    monkeypatch.setattr(rate_limit, "metrics", rate_limit.AdmissionMetrics())
+    monkeypatch.setattr(rate_limit, "RATE_LIMIT_ENABLED", True)
+    dependency = rate_limit.rate_limit("login")
+    request = make_request()
+
+    for _ in range(rate_limit.IP_BURST // rate_limit.ROUTE_COSTS["login"]):
+        asyncio.run(dependency(request))
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(dependency(request))
+
+    assert exc.value.status_code == 429
+    assert exc.value.headers["Retry-After"] == "1"
+    assert rate_limit.metrics.shed[("login", "rate_limit")] == 1
+
+
+# --- CONCURRENCY LIMITER ---
+def test_limiter_times_out_when_full_and_admits_after_release():
+    async def scenario():
+        limiter = rate_limit.ConcurrencyLimiter("test", limit=1, queue_timeout=0.05)
+        assert await limiter.acquire()
+        assert not await limiter.acquire()
+        assert limiter.waiting == 0
+
+        waiter = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0.01)
+        limiter.release()
+        assert await waiter
+        assert limiter.in_flight == 1
+
+    asyncio.run(scenario())
+
+
+def test_limit_concurrency_dependency_sheds_on_queue_timeout(monkeypatch):
+    monkeypatch.setattr(rate_limit, "metrics", rate_limit.AdmissionMetrics())
+
+    async def scenario():
+        limiter = rate_limit.ConcurrencyLimiter("test", limit=1, queue_timeout=0.05)
+        dependency = rate_limit.limit_concurrency(limiter)
+        holder = dependency()
+        await holder.__anext__()
+
+        with pytest.raises(HTTPException) as exc:
+            await dependency().__anext__()
+        assert exc.value.status_code == 429
+
+        await holder.aclose()
+        assert limiter.in_flight == 0
+
+    asyncio.run(scenario())
+    assert rate_limit.metrics.shed[("test", "queue_timeout")] == 1
+
+
+# --- CLIENT IP ---
+def test_forwarded_for_ignored_by_default(monkeypatch):
+    monkeypatch.setattr(rate_limit, "TRUSTED_PROXY_HOPS", 0)
+    assert rate_limit.client_ip(make_request(xff="1.1.1.1")) == "10.0.0.1"
+
+
+def test_forwarded_for_with_trusted_proxies(monkeypatch):
+    monkeypatch.setattr(rate_limit, "TRUSTED_PROXY_HOPS", 1)
+    # The left entry is client-supplied; the proxy appended the real peer
+    assert rate_limit.client_ip(make_request(xff="6.6.6.6, 1.1.1.1")) == "1.1.1.1"
+    assert rate_limit.client_ip(make_request()) == "10.0.0.1"
+
+    monkeypatch.setattr(rate_limit, "TRUSTED_PROXY_HOPS", 2)
+    assert rate_limit.client_ip(make_request(xff="6.6.6.6, 1.1.1.1, 172.16.0.2")) == "1.1.1.1"